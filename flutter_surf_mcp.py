@@ -1,15 +1,282 @@
 #!/usr/bin/env python3
-from typing import Any, Dict
+import asyncio
+import functools
+import inspect
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from itertools import compress, repeat
+from operator import attrgetter, contains
+from typing import Any, Dict, NamedTuple, Optional
 from mcp.server.fastmcp import FastMCP
 from app_use.app.app import App
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 # Initialize FastMCP server
 mcp = FastMCP("flutter-control")
 
-# Global variables to store App instance
-app = None
-is_connected = False
+@dataclass
+class _Connection:
+    """The currently connected Flutter app, if any, and its keepalive task.
+
+    debug_paint is the last debug paint setting applied to the app, or None if unknown.
+    lock is held while the app is being replaced, so reconnects don't interleave.
+    """
+    app: Optional[App] = None
+    keepalive: Optional[asyncio.Task] = None
+    debug_paint: Optional[bool] = None
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    @property
+    def is_connected(self) -> bool:
+        """Whether an app is currently connected."""
+        return self.app is not None
+
+# Single connection shared by all tools
+connection = _Connection()
+
+# Seconds between keepalive requests to the connected app
+KEEPALIVE_INTERVAL = 20.0
+
+async def _keepalive(app: App) -> None:
+    """Send a cheap request to the app periodically so its VM service connection stays open."""
+    while True:
+        await asyncio.sleep(KEEPALIVE_INTERVAL)
+        try:
+            await asyncio.to_thread(app.client.is_widget_tree_ready)
+        except Exception:
+            # A failed ping is not fatal; the next tool call reports any real error
+            pass
+
+# Fetches the node attributes used by the formatting and search loops in one call
+_node_fields = attrgetter("unique_id", "widget_type", "key", "child_nodes")
+
+# Short-lived cache of the last fetched app state, so that back-to-back tool
+# calls reuse one widget tree instead of re-fetching it from the VM service.
+# It holds a single entry, tagged with the App it was fetched from. generation
+# counts invalidations, so a fetch that an invalidation overtook is not stored.
+_state_cache = {"ts": 0.0, "app": None, "node_state": None, "search_index": None, "generation": 0}
+
+# Held while fetching, so concurrent tool calls share one fetch
+_state_lock = asyncio.Lock()
+
+def _invalidate_state_cache() -> None:
+    """Forget the cached app state, e.g. after an action that may have changed the UI."""
+    _state_cache.update(app=None, node_state=None, search_index=None, generation=_state_cache["generation"] + 1)
+
+def _last_state(app: App) -> Any:
+    """Return the cached app state if it was fetched from app, else None."""
+    if _state_cache["app"] is not app:
+        return None
+    return _state_cache["node_state"]
+
+def _fresh_state(app: App, ttl: float) -> Any:
+    """Return app's cached state if it is younger than ttl seconds, else None."""
+    node_state = _last_state(app)
+    if node_state is not None and time.monotonic() - _state_cache["ts"] < ttl:
+        return node_state
+    return None
+
+async def _cached_state(app: App, ttl: float = 0.5) -> Any:
+    """Return the state of app, reusing the cached one if it is younger than ttl seconds.
+
+    Callers pass the App they read from the connection, so a reconnect during the
+    call cannot swap it. A fresh state is fetched in a worker thread so the event
+    loop stays free meanwhile. Callers arriving during a fetch wait for it and
+    reuse its result.
+    """
+    node_state = _fresh_state(app, ttl)
+    if node_state is not None:
+        return node_state
+
+    async with _state_lock:
+        # Another caller may have fetched the state while we waited for the lock
+        node_state = _fresh_state(app, ttl)
+        if node_state is not None:
+            return node_state
+
+        generation = _state_cache["generation"]
+        node_state = await asyncio.to_thread(app.get_app_state)
+        # An action that finished during the fetch may have changed the UI after it
+        # was read, so only cache the state if nothing was invalidated meanwhile
+        if _state_cache["generation"] == generation:
+            _state_cache.update(ts=time.monotonic(), app=app, node_state=node_state, search_index=None)
+        return node_state
+
+async def _state_for_widget(app: App, unique_id: int) -> Any:
+    """Return an app state containing unique_id, preferring the last fetched one.
+
+    Widget IDs are assigned per fetch, so an ID the client got from an earlier state
+    refers to that state; it is reused even past its TTL. A fresh state is only
+    fetched when nothing is cached or the ID is not in it.
+    """
+    node_state = _last_state(app)
+    if node_state is not None and unique_id in node_state.selector_map:
+        return node_state
+    return await _cached_state(app)
+
+def _parse_id(widget_id: str) -> Optional[int]:
+    """Parse a widget ID made of ASCII digits, returning None for anything else.
+
+    Checking the digits first avoids raising and catching ValueError for bad input.
+    """
+    return int(widget_id) if widget_id.isascii() and widget_id.isdigit() else None
+
+async def _resolve_target(app: App, widget_id: str) -> tuple:
+    """Parse widget_id and find its node in the state of app.
+
+    Returns ((node_state, node, unique_id), None) on success, or (None, error message).
+    """
+    # Convert widget_id to int for comparison
+    unique_id = _parse_id(widget_id)
+    if unique_id is None:
+        return None, f"Invalid widget ID format: '{widget_id}'. ID should be a non-negative integer."
+
+    # Reuse the last app state if it has the widget, else fetch a fresh one
+    node_state = await _state_for_widget(app, unique_id)
+
+    # Find widget by ID; selector_map is already keyed by unique_id
+    node = node_state.selector_map.get(unique_id)
+    if not node:
+        return None, f"Widget with ID '{widget_id}' not found. Use get_app_state to see available widgets."
+
+    return (node_state, node, unique_id), None
+
+def _widget_info(node: Any) -> tuple:
+    """Return the (type, text, key) of a node for tool feedback, with None for missing values."""
+    text = getattr(node, 'text', None) or None
+    key = node.key if node.key else None
+    return node.widget_type, text, key
+
+def _widget_tool(error_prefix: str, mutates: bool = True, check=None):
+    """Decorate a tool that acts on one widget given by its unique ID.
+
+    The wrapper checks the connection, runs check(*args, **kwargs) if given (a
+    returned string is reported as the error), resolves widget_id and calls
+    fn(app, node_state, target_node, unique_id, *args, **kwargs). Tools that
+    mutate the UI drop the cached state afterwards, and unexpected exceptions
+    are reported as "<error_prefix>: <error>". The tool keeps a widget_id
+    first parameter followed by fn's remaining parameters.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(widget_id: str, *args, **kwargs) -> str:
+            app = connection.app
+            if app is None:
+                return "Not connected to a Flutter app. Please connect first using connect_to_flutter_app."
+
+            # Reject bad arguments before fetching any state
+            if check is not None:
+                error = check(*args, **kwargs)
+                if error:
+                    return error
+
+            try:
+                target, error = await _resolve_target(app, widget_id)
+                if error:
+                    return error
+                node_state, target_node, unique_id = target
+
+                try:
+                    return await fn(app, node_state, target_node, unique_id, *args, **kwargs)
+                finally:
+                    if mutates:
+                        # The action may have changed the UI, so the cached state is stale
+                        _invalidate_state_cache()
+            except Exception as e:
+                return f"{error_prefix}: {str(e)}"
+
+        # Expose widget_id plus fn's own parameters, which is what the MCP schema is built from
+        params = list(inspect.signature(fn).parameters.values())[4:]
+        widget_param = inspect.Parameter("widget_id", inspect.Parameter.POSITIONAL_OR_KEYWORD, annotation=str)
+        wrapper.__signature__ = inspect.Signature([widget_param, *params], return_annotation=str)
+        return wrapper
+    return decorator
+
+def _check_direction(direction: str = "down", *args, **kwargs) -> Optional[str]:
+    """Return an error message unless direction is "up" or "down"."""
+    # Validate direction
+    if direction not in ["up", "down"]:
+        return "Invalid direction. Use 'up' or 'down'."
+    return None
+
+@dataclass(slots=True)
+class _SearchIndex:
+    """Case-folded search fields of every node in one app state, stored column-wise.
+
+    Missing keys and texts are stored as empty strings. by_type maps each case-folded
+    widget type to the positions of its nodes.
+    """
+    nodes: tuple
+    keys: tuple
+    texts: tuple
+    types: tuple
+    by_type: dict
+
+def _search_index(node_state: Any) -> _SearchIndex:
+    """Return the search index for the cached app state.
+
+    The index is built on first use and reused by later searches of the same state.
+    """
+    index = _state_cache["search_index"]
+    if index is None or _state_cache["node_state"] is not node_state:
+        nodes = tuple(node_state.selector_map.values())
+        types = tuple(node.widget_type.casefold() for node in nodes)
+        by_type = {}
+        for pos, wtype in enumerate(types):
+            by_type.setdefault(wtype, []).append(pos)
+        index = _SearchIndex(
+            nodes=nodes,
+            keys=tuple(node.key.casefold() if node.key else "" for node in nodes),
+            texts=tuple((getattr(node, 'text', None) or "").casefold() for node in nodes),
+            types=types,
+            by_type=by_type,
+        )
+        _state_cache["search_index"] = index
+    return index
+
+def _search_by_type(index: _SearchIndex, search_value: str) -> list:
+    """Return nodes whose case-folded widget type contains search_value, in tree order.
+
+    Only the distinct type names are scanned, rather than every node.
+    """
+    positions = sorted(
+        pos
+        for wtype, type_positions in index.by_type.items()
+        if search_value in wtype
+        for pos in type_positions
+    )
+    return [index.nodes[pos] for pos in positions]
+
+def _search_column(nodes: tuple, column: tuple, search_value: str) -> list:
+    """Return the nodes whose case-folded field in column contains search_value."""
+    # An empty search value matches every node that has the field at all
+    mask = map(contains, column, repeat(search_value)) if search_value else column
+    return list(compress(nodes, mask))
+
+def _search_all(index: _SearchIndex, search_value: str) -> list:
+    """Return the nodes whose key, text or type contains search_value."""
+    # Chained `or` stops at the first hit; the type is checked first since every
+    # node has one, while keys and texts are often empty
+    mask = (
+        search_value in wtype or search_value in key or search_value in text
+        for wtype, key, text in zip(index.types, index.keys, index.texts)
+    )
+    return list(compress(index.nodes, mask))
+
+# find_widgets search strategies by search_by value
+_SEARCHES = {
+    "key": lambda index, value: _search_column(index.nodes, index.keys, value),
+    "text": lambda index, value: _search_column(index.nodes, index.texts, value),
+    "type": _search_by_type,
+    "all": _search_all,
+}
 
 @mcp.tool()
 async def connect_to_flutter_app(vm_service_uri: str) -> str:
@@ -18,21 +285,38 @@ async def connect_to_flutter_app(vm_service_uri: str) -> str:
     Args:
         vm_service_uri: The WebSocket URI of the Flutter app's VM service (e.g., ws://127.0.0.1:50505/ws)
     """
-    global app, is_connected
+    # Serialize reconnects, so tools never see a half-replaced connection
+    async with connection.lock:
+        # Stop pinging the previous app
+        if connection.keepalive is not None:
+            connection.keepalive.cancel()
+            connection.keepalive = None
 
-    # Close existing connection if there is one
-    if app is not None:
-        app.close()
+        # Close existing connection if there is one. Closing is best-effort: a stale or
+        # already-closed connection must not stop us from reconnecting. Wait for it to
+        # finish though, since the new App starts its service manager on the same port.
+        old_app, connection.app = connection.app, None
+        if old_app is not None:
+            try:
+                await asyncio.to_thread(old_app.close)
+            except Exception:
+                pass
 
-    try:
-        # Create a new App instance
-        app = App(vm_service_uri=vm_service_uri)
-        is_connected = True
-        
-        return f"Successfully connected to Flutter app at {vm_service_uri}"
-    except Exception as e:
-        is_connected = False
-        return f"Error connecting to Flutter app: {str(e)}"
+        # Drop any state cached from the previous connection
+        _invalidate_state_cache()
+        connection.debug_paint = None
+
+        try:
+            # Create a new App instance
+            app = await asyncio.to_thread(App, vm_service_uri=vm_service_uri)
+
+            # Keep the connection open for the lifetime of the server (App closes it at exit)
+            connection.app = app
+            connection.keepalive = asyncio.create_task(_keepalive(app))
+            
+            return f"Successfully connected to Flutter app at {vm_service_uri}"
+        except Exception as e:
+            return f"Error connecting to Flutter app: {str(e)}"
 
 @mcp.tool()
 async def get_app_state() -> str:
@@ -40,275 +324,242 @@ async def get_app_state() -> str:
     
     Returns a detailed representation of the current UI elements in the app.
     """
-    global app, is_connected
-    
-    if not is_connected or app is None:
+    app = connection.app
+    if app is None:
         return "Not connected to a Flutter app. Please connect first using connect_to_flutter_app."
     
     try:
         # Get app state
-        node_state = app.get_app_state()
-        
-        # Use the to_json method provided by NodeState
-        formatted_state = format_widget_tree(node_state)
+        node_state = await _cached_state(app)
         
-        # if result exceeds maximum length of 1000000 trim the result
-        if len(formatted_state) > 1000000:
-            formatted_state = formatted_state[:1000000]
+        # Render the tree in a worker thread so big trees don't stall other tool calls
+        formatted_state = await asyncio.to_thread(format_widget_tree, node_state, max_chars=MAX_STATE_CHARS)
         
         return formatted_state
     except Exception as e:
         return f"Error getting app state: {str(e)}"
 
 @mcp.tool()
-async def click_widget(widget_id: str) -> str:
+@_widget_tool("Error clicking widget")
+async def click_widget(app: App, node_state: Any, target_node: Any, unique_id: int) -> str:
     """Click on a widget in the Flutter app by its unique ID.
 
     Args:
         widget_id: The unique ID of the widget to click
     """
-    global app, is_connected
+    # Get info for better feedback
+    widget_type, widget_text, widget_key = _widget_info(target_node)
     
-    if not is_connected or app is None:
-        return "Not connected to a Flutter app. Please connect first using connect_to_flutter_app."
+    # Click the widget
+    success = await asyncio.to_thread(app.click_widget_by_unique_id, node_state, unique_id)
     
-    try:
-        # Convert widget_id to int for comparison
-        try:
-            target_unique_id = int(widget_id)
-        except ValueError:
-            return f"Invalid widget ID format: '{widget_id}'. ID should be an integer."
-
-        # Get current app state to have the node_state object
-        node_state = app.get_app_state()
-        
-        # Find widget by ID from selector_map
-        target_node = node_state.selector_map.get(target_unique_id)
-        
-        if not target_node:
-            return f"Widget with ID '{widget_id}' not found. Use get_app_state to see available widgets."
-        
-        # Get info for better feedback
-        widget_type = target_node.widget_type
-        widget_text = target_node.text if hasattr(target_node, 'text') and target_node.text else None
-        widget_key = target_node.key if target_node.key else None
-        
-        # Click the widget
-        success = app.click_widget_by_unique_id(node_state, int(widget_id))
-        
-        if success:
-            return f"Successfully clicked on {widget_type} widget with text '{widget_text}' and key '{widget_key}'."
-        else:
-            return f"Failed to click on {widget_type} widget with text '{widget_text}' and key '{widget_key}'. The widget might not be interactive."
-            
-    except Exception as e:
-        return f"Error clicking widget: {str(e)}"
+    if success:
+        return f"Successfully clicked on {widget_type} widget with text '{widget_text}' and key '{widget_key}'."
+    else:
+        return f"Failed to click on {widget_type} widget with text '{widget_text}' and key '{widget_key}'. The widget might not be interactive."
 
 @mcp.tool()
-async def enter_text(widget_id: str, text: str) -> str:
+@_widget_tool("Error entering text into widget")
+async def enter_text(app: App, node_state: Any, target_node: Any, unique_id: int, text: str) -> str:
     """Enter text into a widget in the Flutter app by its unique ID.
 
     Args:
         widget_id: The unique ID of the widget to enter text into
         text: The text to enter into the widget
     """
-    global app, is_connected
+    # Get info for better feedback
+    widget_type, widget_text, widget_key = _widget_info(target_node)
     
-    if not is_connected or app is None:
-        return "Not connected to a Flutter app. Please connect first using connect_to_flutter_app."
+    # Enter text in the widget
+    success = await asyncio.to_thread(app.enter_text_with_unique_id, node_state, unique_id, text)
     
-    try:
-        # Convert widget_id to int for comparison
-        try:
-            target_unique_id = int(widget_id)
-        except ValueError:
-            return f"Invalid widget ID format: '{widget_id}'. ID should be an integer."
+    if success:
+        return f"Successfully entered text '{text}' into {widget_type} widget with previous text '{widget_text}' and key '{widget_key}'."
+    else:
+        return f"Failed to enter text into {widget_type} widget with text '{widget_text}' and key '{widget_key}'. The widget might not support text input."
 
-        # Get current app state to have the node_state object
-        node_state = app.get_app_state()
-        
-        # Find widget by ID from selector_map
-        target_node = node_state.selector_map.get(target_unique_id)
-        
-        if not target_node:
-            return f"Widget with ID '{widget_id}' not found. Use get_app_state to see available widgets."
-        
-        # Get info for better feedback
-        widget_type = target_node.widget_type
-        widget_text = target_node.text if hasattr(target_node, 'text') and target_node.text else None
-        widget_key = target_node.key if target_node.key else None
-        
-        # Enter text in the widget
-        success = app.enter_text_with_unique_id(node_state, int(widget_id), text)
-        
-        if success:
-            return f"Successfully entered text '{text}' into {widget_type} widget with previous text '{widget_text}' and key '{widget_key}'."
-        else:
-            return f"Failed to enter text into {widget_type} widget with text '{widget_text}' and key '{widget_key}'. The widget might not support text input."
-            
-    except Exception as e:
-        return f"Error entering text into widget: {str(e)}"
+# One widget record; the optional lines are filled in preformatted or left empty
+_MATCH_TEMPLATE = (
+    "{label}Type: {wtype}\n"
+    "   ID: {uid}\n"
+    "   Parent ID: {pid}\n"
+    "   Children IDs: {cids}\n"
+    "{keyline}{textline}{interactive}"
+)
+
+# Closing line of each find_widgets match, which also ends the record
+_MATCH_INTERACTIVE = "   Interactive: Yes\n\n"
+_MATCH_NOT_INTERACTIVE = "   Interactive: No\n\n"
+
+class _MatchRecord(NamedTuple):
+    """The fields of one widget that find_widgets and get_widget report."""
+    unique_id: int
+    widget_type: str
+    parent_id: Optional[int]
+    child_ids: tuple
+    key: Optional[str]
+    text: Optional[str]
+    interactive: bool
+
+def _match_record(node: Any) -> _MatchRecord:
+    """Capture the reported fields of a node in one pass."""
+    uid, wtype, key, kids = _node_fields(node)
+    parent = node.parent
+    return _MatchRecord(
+        uid,
+        wtype,
+        parent.unique_id if parent else None,
+        tuple(child.unique_id for child in kids),
+        key or None,
+        getattr(node, 'text', None) or None,
+        bool(node.is_interactive),
+    )
+
+def _format_match(record: _MatchRecord, label: str) -> str:
+    """Format one widget record as listed by find_widgets, starting with label (e.g. "1. ")."""
+    return _MATCH_TEMPLATE.format_map({
+        "label": label,
+        "wtype": record.widget_type,
+        "uid": record.unique_id,
+        "pid": 'None' if record.parent_id is None else record.parent_id,
+        "cids": ', '.join(map(str, record.child_ids)) if record.child_ids else 'None',
+        "keyline": f"   Key: {record.key}\n" if record.key else "",
+        "textline": f"   Text: {record.text}\n" if record.text else "",
+        "interactive": _MATCH_INTERACTIVE if record.interactive else _MATCH_NOT_INTERACTIVE,
+    })
+
+def _format_records_ndjson(records: Any) -> str:
+    """Serialize widget records as compact JSON, one object per line."""
+    if orjson is not None:
+        return b"\n".join(orjson.dumps(record._asdict()) for record in records).decode()
+    return "\n".join(
+        json.dumps(record._asdict(), ensure_ascii=False, separators=(",", ":")) for record in records
+    )
+
+def _format_matches(matches: list, search_value: str, search_by: str, limit: int, verbose: bool = False) -> str:
+    """Format the find_widgets result, listing at most limit matches (all if limit <= 0).
+
+    Matches are listed one JSON object per line, or as labelled text blocks if verbose.
+    """
+    # Only list up to limit matches, to keep the response small
+    shown = matches[:limit] if limit > 0 else matches
+    header = f"Found {len(matches)} widgets matching '{search_value}' in {search_by}"
+    if len(shown) < len(matches):
+        header += f" (showing the first {len(shown)})"
+
+    # The compact format serializes all matches in one go
+    if not verbose:
+        return f"{header}:\n{_format_records_ndjson(map(_match_record, shown))}"
+
+    # Collect output fragments in a list and join once at the end
+    out = [f"{header}:\n\n"]
+    ap = out.append
+
+    for i, record in enumerate(map(_match_record, shown), 1):
+        ap(_format_match(record, f"{i}. "))
+
+    return "".join(out)
+
+@mcp.tool()
+@_widget_tool("Error getting widget", mutates=False)
+async def get_widget(app: App, node_state: Any, target_node: Any, unique_id: int) -> str:
+    """Get the details of a single widget in the Flutter app by its unique ID.
+
+    Cheaper than get_app_state when only one widget is of interest. Unlike
+    find_widgets, it also lists the widget's properties.
+
+    Args:
+        widget_id: The unique ID of the widget to describe
+    """
+    details = _format_match(_match_record(target_node), '   ')
+
+    # Element nodes carry their widget properties; text nodes have none
+    properties = getattr(target_node, 'properties', None)
+    if properties:
+        details = f"{details.rstrip()}\n   Properties: {properties}\n\n"
+
+    return f"Widget with ID '{unique_id}':\n\n{details}"
 
 @mcp.tool()
-async def find_widgets(search_by: str = "all", search_value: str = "") -> str:
+async def find_widgets(search_by: str = "all", search_value: str = "", limit: int = 50, verbose: bool = False) -> str:
     """Find widgets in the Flutter app by key, text, or type.
 
+    Each match is listed as one JSON object per line, with its unique_id, widget_type,
+    parent_id, child_ids, key, text and interactive fields.
+
     Args:
         search_by: What to search by - "key", "text", "type", or "all" (default)
         search_value: The value to search for
+        limit: Maximum number of matches to list (default 50, 0 for no limit)
+        verbose: List each match as a labelled text block instead of JSON
     """
-    global app, is_connected
-    
-    if not is_connected or app is None:
+    app = connection.app
+    if app is None:
         return "Not connected to a Flutter app. Please connect first using connect_to_flutter_app."
     
     try:
         # Get current app state
-        node_state = app.get_app_state()
+        node_state = await _cached_state(app)
         
-        matches = []
-        search_value = search_value.lower()
+        # Fold case once, matching the case-folded fields in the search index
+        search_value = search_value.casefold()
         
-        # Search by the specified criteria
-        for uid, node in node_state.selector_map.items():
-            if search_by == "key" and node.key and search_value in node.key.lower():
-                matches.append(node)
-            elif search_by == "text" and hasattr(node, 'text') and node.text and search_value in node.text.lower():
-                matches.append(node)
-            elif search_by == "type" and search_value in node.widget_type.lower():
-                matches.append(node)
-            elif search_by == "all":
-                # Search in all fields
-                if (node.key and search_value in node.key.lower()) or \
-                   (hasattr(node, 'text') and node.text and search_value in node.text.lower()) or \
-                   (search_value in node.widget_type.lower()):
-                    matches.append(node)
+        # Pick the search strategy once; unknown search_by values match nothing
+        search = _SEARCHES.get(search_by)
+        matches = search(_search_index(node_state), search_value) if search else []
         
         # Format the results
         if not matches:
             return f"No widgets found matching '{search_value}' in {search_by}."
         
-        result = f"Found {len(matches)} widgets matching '{search_value}' in {search_by}:\n\n"
-        
-        for i, node in enumerate(matches, 1):
-            node_json = node.to_json()
-            result += f"{i}. Type: {node.widget_type}\n"
-            result += f"   ID: {node.unique_id}\n"
-            result += f"   Parent ID: {node.parent.unique_id if node.parent else 'None'}\n"
-            result += f"   Children IDs: {', '.join([str(child.unique_id) for child in node.child_nodes]) if node.child_nodes else 'None'}\n"
-            
-            if 'properties' in node_json:
-                result += f"   Properties: {node_json['properties']}\n"
-            
-            if node.key:
-                result += f"   Key: {node.key}\n"
-            
-            if hasattr(node, 'text') and node.text:
-                result += f"   Text: {node.text}\n"
-                
-            result += f"   Interactive: {'Yes' if node.is_interactive else 'No'}\n"
-            result += "\n"
-            
-        return result
+        # Render the matches in a worker thread so the event loop stays free
+        return await asyncio.to_thread(_format_matches, matches, search_value, search_by, limit, verbose)
             
     except Exception as e:
         return f"Error finding widgets: {str(e)}"
 
 @mcp.tool()
-async def scroll_widget_into_view(widget_id: str) -> str:
+@_widget_tool("Error scrolling widget into view")
+async def scroll_widget_into_view(app: App, node_state: Any, target_node: Any, unique_id: int) -> str:
     """Scroll a widget into view in the Flutter app by its unique ID.
 
     Args:
         widget_id: The unique ID of the widget to scroll into view
     """
-    global app, is_connected
+    # Get info for better feedback
+    widget_type, widget_text, widget_key = _widget_info(target_node)
     
-    if not is_connected or app is None:
-        return "Not connected to a Flutter app. Please connect first using connect_to_flutter_app."
+    # Scroll the widget into view
+    success = await asyncio.to_thread(app.scroll_into_view, node_state, unique_id)
     
-    try:
-        # Convert widget_id to int for comparison
-        try:
-            target_unique_id = int(widget_id)
-        except ValueError:
-            return f"Invalid widget ID format: '{widget_id}'. ID should be an integer."
-
-        # Get current app state to have the node_state object
-        node_state = app.get_app_state()
-        
-        # Find widget by ID from selector_map
-        target_node = node_state.selector_map.get(target_unique_id)
-        
-        if not target_node:
-            return f"Widget with ID '{widget_id}' not found. Use get_app_state to see available widgets."
-        
-        # Get info for better feedback
-        widget_type = target_node.widget_type
-        widget_text = target_node.text if hasattr(target_node, 'text') and target_node.text else None
-        widget_key = target_node.key if target_node.key else None
-        
-        # Scroll the widget into view
-        success = app.scroll_into_view(node_state, target_unique_id)
-        
-        if success:
-            return f"Successfully scrolled {widget_type} widget into view with text '{widget_text}' and key '{widget_key}'."
-        else:
-            return f"Failed to scroll {widget_type} widget into view with text '{widget_text}' and key '{widget_key}'. The widget might not be scrollable."
-            
-    except Exception as e:
-        return f"Error scrolling widget into view: {str(e)}"
+    if success:
+        return f"Successfully scrolled {widget_type} widget into view with text '{widget_text}' and key '{widget_key}'."
+    else:
+        return f"Failed to scroll {widget_type} widget into view with text '{widget_text}' and key '{widget_key}'. The widget might not be scrollable."
 
 @mcp.tool()
-async def scroll_widget_normal(widget_id: str, direction: str = "down") -> str:
+@_widget_tool("Error scrolling widget", check=_check_direction)
+async def scroll_widget_normal(app: App, node_state: Any, target_node: Any, unique_id: int, direction: str = "down") -> str:
     """Scroll a widget up or down in the Flutter app using standard scrolling.
 
     Args:
         widget_id: The unique ID of the widget to scroll
         direction: The scroll direction, either "up" or "down"
     """
-    global app, is_connected
-    
-    if not is_connected or app is None:
-        return "Not connected to a Flutter app. Please connect first using connect_to_flutter_app."
+    # Get info for better feedback
+    widget_type, widget_text, widget_key = _widget_info(target_node)
     
-    # Validate direction
-    if direction not in ["up", "down"]:
-        return "Invalid direction. Use 'up' or 'down'."
+    # Scroll the widget
+    success = await asyncio.to_thread(app.scroll_up_or_down, node_state, unique_id, direction=direction)
     
-    try:
-        # Convert widget_id to int for comparison
-        try:
-            target_unique_id = int(widget_id)
-        except ValueError:
-            return f"Invalid widget ID format: '{widget_id}'. ID should be an integer."
-
-        # Get current app state to have the node_state object
-        node_state = app.get_app_state()
-        
-        # Find widget by ID from selector_map
-        target_node = node_state.selector_map.get(target_unique_id)
-        
-        if not target_node:
-            return f"Widget with ID '{widget_id}' not found. Use get_app_state to see available widgets."
-        
-        # Get info for better feedback
-        widget_type = target_node.widget_type
-        widget_text = target_node.text if hasattr(target_node, 'text') and target_node.text else None
-        widget_key = target_node.key if target_node.key else None
-        
-        # Scroll the widget
-        success = app.scroll_up_or_down(node_state, target_unique_id, direction=direction)
-        
-        if success:
-            return f"Successfully scrolled {direction} {widget_type} widget with text '{widget_text}' and key '{widget_key}'."
-        else:
-            return f"Failed to scroll {direction} {widget_type} widget with text '{widget_text}' and key '{widget_key}'. The widget might not be scrollable."
-            
-    except Exception as e:
-        return f"Error scrolling widget: {str(e)}"
+    if success:
+        return f"Successfully scrolled {direction} {widget_type} widget with text '{widget_text}' and key '{widget_key}'."
+    else:
+        return f"Failed to scroll {direction} {widget_type} widget with text '{widget_text}' and key '{widget_key}'. The widget might not be scrollable."
 
 @mcp.tool()
-async def scroll_widget(widget_id: str, direction: str = "down", dx: int = 0, dy: int = 100, duration_ms: int = 300) -> str:
+@_widget_tool("Error scrolling widget with extended parameters", check=_check_direction)
+async def scroll_widget(app: App, node_state: Any, target_node: Any, unique_id: int, direction: str = "down", dx: int = 0, dy: int = 100, duration_ms: int = 300) -> str:
     """Scroll a widget with extended parameters in the Flutter app.
 
     Args:
@@ -318,54 +569,25 @@ async def scroll_widget(widget_id: str, direction: str = "down", dx: int = 0, dy
         dy: Vertical scroll amount (positive = down, negative = up)
         duration_ms: Duration of the scroll gesture in milliseconds
     """
-    global app, is_connected
+    # Get info for better feedback
+    widget_type, widget_text, widget_key = _widget_info(target_node)
     
-    if not is_connected or app is None:
-        return "Not connected to a Flutter app. Please connect first using connect_to_flutter_app."
+    # Scroll the widget with extended parameters
+    success = await asyncio.to_thread(
+        app.scroll_up_or_down_extended,
+        node_state, 
+        unique_id, 
+        direction=direction, 
+        dx=dx, 
+        dy=dy, 
+        duration_microseconds=duration_ms * 1000,  # Convert ms to microseconds
+        frequency=60
+    )
     
-    # Validate direction
-    if direction not in ["up", "down"]:
-        return "Invalid direction. Use 'up' or 'down'."
-    
-    try:
-        # Convert widget_id to int for comparison
-        try:
-            target_unique_id = int(widget_id)
-        except ValueError:
-            return f"Invalid widget ID format: '{widget_id}'. ID should be an integer."
-
-        # Get current app state to have the node_state object
-        node_state = app.get_app_state()
-        
-        # Find widget by ID from selector_map
-        target_node = node_state.selector_map.get(target_unique_id)
-        
-        if not target_node:
-            return f"Widget with ID '{widget_id}' not found. Use get_app_state to see available widgets."
-        
-        # Get info for better feedback
-        widget_type = target_node.widget_type
-        widget_text = target_node.text if hasattr(target_node, 'text') and target_node.text else None
-        widget_key = target_node.key if target_node.key else None
-        
-        # Scroll the widget with extended parameters
-        success = app.scroll_up_or_down_extended(
-            node_state, 
-            target_unique_id, 
-            direction=direction, 
-            dx=dx, 
-            dy=dy, 
-            duration_microseconds=duration_ms * 1000,  # Convert ms to microseconds
-            frequency=60
-        )
-        
-        if success:
-            return f"Successfully performed extended scroll {direction} on {widget_type} widget with text '{widget_text}' and key '{widget_key}'."
-        else:
-            return f"Failed to perform extended scroll {direction} on {widget_type} widget with text '{widget_text}' and key '{widget_key}'. The widget might not be scrollable."
-            
-    except Exception as e:
-        return f"Error scrolling widget with extended parameters: {str(e)}"
+    if success:
+        return f"Successfully performed extended scroll {direction} on {widget_type} widget with text '{widget_text}' and key '{widget_key}'."
+    else:
+        return f"Failed to perform extended scroll {direction} on {widget_type} widget with text '{widget_text}' and key '{widget_key}'. The widget might not be scrollable."
 
 @mcp.tool()
 async def toggle_debug_paint_feature(enable: bool = True) -> str:
@@ -374,76 +596,118 @@ async def toggle_debug_paint_feature(enable: bool = True) -> str:
     Args:
         enable: True to enable debug paint, False to disable. Defaults to True.
     """
-    global app, is_connected
-    
-    if not is_connected or app is None:
+    app = connection.app
+    if app is None:
         return "Not connected to a Flutter app. Please connect first using connect_to_flutter_app."
         
+    status = "enabled" if enable else "disabled"
+
+    # Skip the request if the app is already in the requested state
+    if connection.debug_paint == enable:
+        return f"Debug paint feature is already {status}."
+
     try:
-        response = app.client.toggle_debug_paint(enable=enable)
+        response = await asyncio.to_thread(app.client.toggle_debug_paint, enable=enable)
         if response.success:
-            status = "enabled" if enable else "disabled"
+            connection.debug_paint = enable
             return f"Debug paint feature has been {status}."
         else:
             return f"Failed to toggle debug paint: {response.message}"
     except Exception as e:
         return f"Error toggling debug paint: {str(e)}"
 
-def format_widget_tree(node_state: Any) -> str:
-    """Format the widget tree in a readable way for Claude to understand the UI structure."""
+def _env_int(name: str, default: int, minimum: int) -> int:
+    """Read an integer setting from the environment.
+
+    Unset or non-integer values give default, and smaller values are raised to minimum.
+    """
     try:
-        # Use the to_json method provided by NodeState
-        if hasattr(node_state, 'to_json'):
-            json_data = node_state.to_json()
-            
-            # Create a human-readable structure with the JSON data
-            result = "Flutter App UI Structure:\n\n"
-            
-            # Format the element tree
-            result += "Element Tree:\n"
-            result += format_json_node(json_data['element_tree'], 0)
-            
+        value = int(os.environ.get(name, default))
+    except ValueError:
+        return default
+    return max(value, minimum)
+
+# Longest get_app_state response, in characters; the tree walk stops once it is reached.
+# The minimum leaves room for the header and the first few nodes.
+MAX_STATE_CHARS = _env_int("FLUTTER_SURF_MAX_STATE_CHARS", 1_000_000, minimum=1_000)
+
+# When set, get_app_state returns the element tree as JSON (requires orjson)
+STATE_JSON = os.environ.get("GET_APP_STATE_JSON") == "1"
+
+def _format_widget_tree_json(node_state: Any, max_chars: int) -> str:
+    """Serialize the element tree as indented JSON, trimmed to max_chars."""
+    data = orjson.dumps(node_state.element_tree.to_json(), option=orjson.OPT_INDENT_2)
+    # Trimming bytes may split a multi-byte character; drop the partial tail
+    return data[:max_chars].decode(errors="ignore")
+
+# Indentation strings for the first tree depths; deeper levels are built on demand
+_INDENTS = tuple("  " * depth for depth in range(64))
+
+def format_widget_tree(node_state: Any, max_chars: int = MAX_STATE_CHARS) -> str:
+    """Format the widget tree in a readable way for Claude to understand the UI structure.
+
+    Traversal stops once the output reaches max_chars, and the result is trimmed to that length.
+    """
+    try:
+        # Serialize straight to JSON when asked to and orjson is available
+        if STATE_JSON and orjson is not None and hasattr(node_state, 'element_tree'):
+            try:
+                return _format_widget_tree_json(node_state, max_chars)
+            except (RecursionError, orjson.JSONEncodeError):
+                # Trees too deep for to_json(), or nested beyond orjson's 255-level
+                # limit, fall back to the iterative walk below
+                pass
+
+        if hasattr(node_state, 'element_tree'):
+            # Collect output fragments in a list and join once at the end
+            parts = ["Flutter App UI Structure:\n\n", "Element Tree:\n"]
+            total = sum(map(len, parts))
+
+            # Walk the element tree depth-first with an explicit stack
+            stack = [(node_state.element_tree, 0)]
+            while stack and total < max_chars:
+                node, depth = stack.pop()
+                uid, wtype, key, kids = _node_fields(node)
+                # Node lines use the node's indent, detail lines one level deeper
+                if depth + 1 < len(_INDENTS):
+                    indent, sub = _INDENTS[depth], _INDENTS[depth + 1]
+                else:
+                    indent = "  " * depth
+                    sub = indent + "  "
+                text = getattr(node, 'text', None)
+                interactive = getattr(node, 'is_interactive', None)
+
+                # Emit the ID/type line plus any text, key, interactivity and child count
+                block = (
+                    f"{indent}ID: {uid} - Type: {wtype}\n"
+                    + (f"{sub}Text: {text}\n" if text else "")
+                    + (f"{sub}Key: {key}\n" if key else "")
+                    + ("" if interactive is None else f"{sub}Interactive: {'Yes' if interactive else 'No'}\n")
+                    + (f"{sub}Children: {len(kids)}\n" if kids else "")
+                )
+                parts.append(block)
+                total += len(block)
+
+                # Queue children in reverse so they are emitted in order
+                if kids:
+                    stack.extend(zip(reversed(kids), repeat(depth + 1)))
+
+            # The summary would be cut off anyway once the budget is spent
+            if total >= max_chars:
+                return "".join(parts)[:max_chars]
+
             # Optional: Add summary info
-            result += "\nUI Summary:\n"
-            result += f"- Total nodes: {len(node_state.selector_map)}\n"
-            result += f"- Interactive nodes: {sum(1 for node in node_state.selector_map.values() if node.is_interactive)}\n"
-            
-            return result
+            parts.append("\nUI Summary:\n")
+            parts.append(f"- Total nodes: {len(node_state.selector_map)}\n")
+            parts.append(f"- Interactive nodes: {sum(1 for node in node_state.selector_map.values() if node.is_interactive)}\n")
+
+            return "".join(parts)[:max_chars]
         else:
-            # Fallback for cases where to_json is not available
-            return f"Node state doesn't support to_json serialization. Raw data: {str(node_state)}"
+            # Fallback for cases where there is no element tree to walk
+            return f"Node state doesn't have an element tree. Raw data: {str(node_state)}"
     except Exception as e:
         return f"Error formatting widget tree: {str(e)}\nRaw data: {str(node_state)}"
 
-def format_json_node(node_json, depth=0):
-    """Recursively format a node JSON structure with indentation."""
-    indent = "  " * depth
-    result = f"{indent}ID: {node_json['id']} - Type: {node_json['widget_type']}\n"
-    
-    # Add text if present
-    if 'text' in node_json and node_json['text']:
-        result += f"{indent}  Text: {node_json['text']}\n"
-    
-    # Add key if present
-    if 'key' in node_json and node_json['key']:
-        result += f"{indent}  Key: {node_json['key']}\n"
-    
-    # Add interactivity info
-    if 'interactive' in node_json:
-        result += f"{indent}  Interactive: {'Yes' if node_json['interactive'] else 'No'}\n"
-    
-    # Add properties if present
-    if 'properties' in node_json and node_json['properties']:
-        result += f"{indent}  Properties: {str(node_json['properties'])}\n"
-    
-    # Add children
-    if 'children' in node_json and node_json['children']:
-        result += f"{indent}  Children: {len(node_json['children'])}\n"
-        for child in node_json['children']:
-            result += format_json_node(child, depth + 1)
-    
-    return result
-
 if __name__ == "__main__":
     # Initialize and run the server
     mcp.run(transport='stdio')
\ No newline at end of file